@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Build a TensorRT engine from the exported SepFormer ONNX model
+"""
+
+import argparse
+import os
+import sys
+import tensorrt as trt
+
+SAMPLE_RATE = 16000
+
+def build_trt_engine(onnx_path, engine_path, min_seconds=1, opt_seconds=5, max_seconds=30, fp16=True):
+    logger = trt.Logger(trt.Logger.WARNING)
+    builder = trt.Builder(logger)
+    network = builder.create_network(
+        1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH)
+    )
+    parser = trt.OnnxParser(network, logger)
+
+    print(f"Parsing ONNX model from {onnx_path}")
+    with open(onnx_path, 'rb') as f:
+        if not parser.parse(f.read()):
+            print("✗ Failed to parse ONNX model:")
+            for i in range(parser.num_errors):
+                print(f"  {parser.get_error(i)}")
+            return False
+
+    config = builder.create_builder_config()
+    config.set_memory_pool_limit(trt.MemoryPoolType.WORKSPACE, 1 << 30)
+    if fp16:
+        if builder.platform_has_fast_fp16:
+            config.set_flag(trt.BuilderFlag.FP16)
+            print("✓ FP16 enabled")
+        else:
+            print("⚠ Platform has no fast FP16, building FP32 engine")
+
+    # The exported model has a dynamic time axis, so TensorRT needs the
+    # range of input lengths it will be asked to run
+    input_name = network.get_input(0).name
+    profile = builder.create_optimization_profile()
+    profile.set_shape(
+        input_name,
+        (1, SAMPLE_RATE * min_seconds),
+        (1, SAMPLE_RATE * opt_seconds),
+        (1, SAMPLE_RATE * max_seconds)
+    )
+    config.add_optimization_profile(profile)
+    print(f"Optimization profile for '{input_name}': {min_seconds}s / {opt_seconds}s / {max_seconds}s")
+
+    print("Building engine (this can take several minutes)...")
+    serialized_engine = builder.build_serialized_network(network, config)
+    if serialized_engine is None:
+        print("✗ Engine build failed")
+        return False
+
+    os.makedirs(os.path.dirname(engine_path), exist_ok=True)
+    with open(engine_path, 'wb') as f:
+        f.write(serialized_engine)
+    print(f"✓ Engine saved to {engine_path}")
+    return True
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build a TensorRT engine for SepFormer')
+    parser.add_argument('--onnx', default='models/sepformer/sepformer.onnx',
+                        help='Path to the exported ONNX model')
+    parser.add_argument('--engine', default='models/sepformer/sepformer.engine',
+                        help='Where to write the serialized engine')
+    parser.add_argument('--min-seconds', type=int, default=1)
+    parser.add_argument('--opt-seconds', type=int, default=5)
+    parser.add_argument('--max-seconds', type=int, default=30)
+    parser.add_argument('--fp32', action='store_true',
+                        help='Build an FP32 engine instead of FP16')
+    args = parser.parse_args()
+
+    try:
+        ok = build_trt_engine(
+            args.onnx,
+            args.engine,
+            min_seconds=args.min_seconds,
+            opt_seconds=args.opt_seconds,
+            max_seconds=args.max_seconds,
+            fp16=not args.fp32
+        )
+    except FileNotFoundError:
+        print("✗ Model file not found. Please run export-sepformer-to-onnx.py first")
+        ok = False
+    sys.exit(0 if ok else 1)
@@ -3,34 +3,104 @@
 Export SpeechBrain SepFormer model to ONNX format for use in Node.js
 """
 
+import argparse
+import shutil
 import torch
 import torch.onnx
 import os
 from speechbrain.inference.separation import SepformerSeparation
 
-def export_sepformer_to_onnx():
-    print("Loading SepFormer model...")
-    model = SepformerSeparation.from_hparams(
-        source='speechbrain/resepformer-wsj02mix',
-        savedir='models/sepformer/temp'
-    )
+# Fixed input lengths (seconds) for the static-shape exports
+BUCKET_SECONDS = [2, 5, 10, 20]
+
+MODEL_SOURCE = 'speechbrain/resepformer-wsj02mix'
+
+class SepFormerPipeline(torch.nn.Module):
+    """
+    Encoder -> masknet -> decoder as one module, mirroring
+    SepformerSeparation.separate_batch, so the exported graph contains the
+    whole separator rather than a single sub-module
+
+    Outputs [batch, sources, time].
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.encoder = model.mods['encoder']
+        self.masknet = model.mods['masknet']
+        self.decoder = model.mods['decoder']
+        self.num_spks = model.hparams.num_spks
+        # The decoder output falls short of the input by less than the encoder
+        # stride; padding by a constant keeps the traced graph branch-free
+        conv = next(m for m in self.encoder.modules() if isinstance(m, torch.nn.Conv1d))
+        self.length_pad = conv.stride[0]
+
+    def forward(self, mix):
+        mix_w = self.encoder(mix)
+        est_mask = self.masknet(mix_w)  # [sources, batch, channels, frames]
+        sep_h = mix_w.unsqueeze(0) * est_mask
+        est_source = torch.stack(
+            [self.decoder(sep_h[i]) for i in range(self.num_spks)],
+            dim=1
+        )
+        est_source = torch.nn.functional.pad(est_source, (0, self.length_pad))
+        return est_source[:, :, :mix.size(1)]
+
+def export_sepformer_to_onnx(fp16=True, int8=True, calibration_dir=None, buckets=True,
+                             student=False, student_source=None, student_layers=2):
+    """
+    Export the SepFormer model, or with student=True a smaller student model
+
+    The student is loaded from student_source (default: the full model's
+    checkpoint) and every transformer layer stack in its masknet is cut to
+    its first student_layers layers. It is written to sepformer_student.onnx
+    so it can be A/B tested against sepformer.onnx.
+    """
+    print(f"Loading SepFormer {'student ' if student else ''}model...")
+    if student:
+        model = SepformerSeparation.from_hparams(
+            source=student_source or MODEL_SOURCE,
+            savedir='models/sepformer/student_temp' if student_source else 'models/sepformer/temp'
+        )
+        if not _truncate_masknet_layers(model.mods['masknet'], student_layers):
+            raise ValueError(
+                f"No masknet layer stacks deeper than {student_layers} layers, "
+                "student would be identical to the full model"
+            )
+    else:
+        model = SepformerSeparation.from_hparams(
+            source=MODEL_SOURCE,
+            savedir='models/sepformer/temp'
+        )
     
     print(f"Available modules: {list(model.mods.keys())}")
     
-    # Get the underlying separation model
-    # Try different possible keys
+    # Export the full separator when its parts are available
     sep_model = None
-    for key in ['separator', 'sepformer', 'encoder', 'masknet']:
-        if key in model.mods:
-            sep_model = model.mods[key]
-            print(f"Found model at key: {key}")
-            break
+    if all(key in model.mods for key in ['encoder', 'masknet', 'decoder']):
+        sep_model = SepFormerPipeline(model)
+        print("Exporting encoder -> masknet -> decoder pipeline")
+    else:
+        # Get the underlying separation model
+        # Try different possible keys
+        for key in ['separator', 'sepformer', 'encoder', 'masknet']:
+            if key in model.mods:
+                sep_model = model.mods[key]
+                print(f"Found model at key: {key}")
+                break
     
     if sep_model is None:
         print("Could not find separator model. Available keys:", list(model.mods.keys()))
         print("\nTrying to use the model directly...")
         sep_model = model
     
+    # The truncated masknet only matters if it is part of the exported graph
+    if student and not any(m is model.mods['masknet'] for m in sep_model.modules()):
+        raise ValueError(
+            "The exported module does not contain the truncated masknet, "
+            "student would be identical to the full model"
+        )
+    
     if hasattr(sep_model, 'eval'):
         sep_model.eval()
     
@@ -94,34 +164,63 @@ def export_sepformer_to_onnx():
             return
     
     # Export to ONNX
-    output_path = 'models/sepformer/sepformer.onnx'
+    output_path = 'models/sepformer/sepformer_student.onnx' if student else 'models/sepformer/sepformer.onnx'
     os.makedirs('models/sepformer', exist_ok=True)
     
     print(f"\nExporting to ONNX: {output_path}")
     
     try:
-        torch.onnx.export(
-            sep_model,
-            dummy_audio,
-            output_path,
-            export_params=True,
-            opset_version=14,
-            do_constant_folding=True,
-            input_names=['audio'],
-            output_names=['separated_audio'],
-            dynamic_axes={
-                'audio': {0: 'batch', 1: 'time'},
-                'separated_audio': {0: 'batch', 2: 'time'}
-            }
-        )
-        print(f"✓ Model exported successfully to {output_path}")
-        
-        # Verify the exported model
-        print("\nVerifying exported ONNX model...")
         import onnx
-        onnx_model = onnx.load(output_path)
+
+        # FP32 sanity export first, so a broken graph is caught before
+        # precision becomes a second variable. It is kept as the reference
+        # for the INT8 model.
+        fp32_path = output_path.replace('.onnx', '_fp32.onnx')
+        _export_onnx(sep_model, dummy_audio, fp32_path)
+        print("\nVerifying exported ONNX model (FP32)...")
+        onnx_model = onnx.load(fp32_path)
         onnx.checker.check_model(onnx_model)
-        print("✓ ONNX model is valid")
+        print(f"✓ FP32 ONNX model is valid, saved to {fp32_path}")
+
+        # Quantize from the FP32 graph; ORT quantization does not accept FP16 input
+        if int8:
+            _quantize_int8(fp32_path, output_path.replace('.onnx', '_int8.onnx'), calibration_dir)
+
+        export_dtype = torch.float32
+        fp16_ok = False
+        if fp16:
+            print("\nRe-exporting with FP16 weights and activations...")
+            try:
+                _export_onnx(sep_model.half(), dummy_audio.half(), output_path)
+                onnx_model = onnx.load(output_path)
+                onnx.checker.check_model(onnx_model)
+                export_dtype = torch.float16
+                fp16_ok = True
+                print("✓ FP16 ONNX model is valid")
+            except Exception as e:
+                print(f"⚠ FP16 export failed ({e}), keeping FP32 model")
+                sep_model.float()
+        if not fp16_ok:
+            shutil.copyfile(fp32_path, output_path)
+            _remove_stale_optimized(output_path)
+            onnx_model = onnx.load(output_path)
+        
+        print(f"✓ Model exported successfully to {output_path}")
+        _check_layer_norm(onnx_model)
+        
+        # Static shapes let ORT plan memory once and constant-fold T-dependent
+        # ops; the dynamic model above remains for longer inputs
+        if buckets:
+            print("\nExporting fixed-length bucket models...")
+            for seconds in BUCKET_SECONDS:
+                bucket_path = output_path.replace('.onnx', f'_{seconds}s.onnx')
+                bucket_audio = torch.randn(1, 16000 * seconds, dtype=export_dtype)
+                try:
+                    _export_onnx(sep_model, bucket_audio, bucket_path, dynamic=False)
+                    onnx.checker.check_model(onnx.load(bucket_path))
+                    print(f"✓ {seconds}s bucket exported to {bucket_path}")
+                except Exception as e:
+                    print(f"⚠ {seconds}s bucket export failed: {e}")
         
         # Print model info
         print("\nModel Information:")
@@ -144,6 +243,187 @@ def export_sepformer_to_onnx():
     print("   - Modify your TypeScript code to handle fixed 2-source output")
     print("   - Run the model multiple times for >2 speakers")
     print("\n3. Update your TypeScript code if needed")
+    print("\n4. For GPU deployment, build a TensorRT engine:")
+    print(f"   python scripts/build-trt-engine.py --onnx {output_path}")
+
+def _truncate_masknet_layers(masknet, num_layers):
+    """
+    Keep only the first num_layers of every transformer layer stack in masknet
+
+    Returns:
+        Number of layer stacks that were truncated
+    """
+    truncated = 0
+    for name, module in masknet.named_modules():
+        layers = getattr(module, 'layers', None)
+        if isinstance(layers, torch.nn.ModuleList) and len(layers) > num_layers:
+            print(f"  {name}.layers: {len(layers)} -> {num_layers}")
+            module.layers = layers[:num_layers]
+            truncated += 1
+    return truncated
+
+def _export_onnx(sep_model, dummy_audio, output_path, dynamic=True):
+    # Trace first so the exporter sees one frozen TorchScript graph instead of
+    # re-walking the eager-mode Python on every op
+    try:
+        with torch.no_grad():
+            export_model = torch.jit.trace(sep_model, dummy_audio, strict=False)
+    except Exception as e:
+        print(f"⚠ torch.jit.trace failed ({e}), exporting eager-mode module")
+        export_model = sep_model
+    
+    torch.onnx.export(
+        export_model,
+        dummy_audio,
+        output_path,
+        export_params=True,
+        # Opset 17 supports FP16 MatMul/LayerNormalization natively
+        opset_version=17,
+        do_constant_folding=True,
+        input_names=['audio'],
+        output_names=['separated_audio'],
+        dynamic_axes={
+            'audio': {0: 'batch', 1: 'time'},
+            'separated_audio': {0: 'batch', 2: 'time'}
+        } if dynamic else None,
+        # The traced ScriptModule needs the TorchScript exporter, which is no
+        # longer the default in newer torch releases
+        dynamo=False
+    )
+    _remove_stale_optimized(output_path)
+
+def _check_layer_norm(onnx_model):
+    """Report whether LayerNorm was exported as the fused opset-17 op"""
+    op_types = [node.op_type for node in onnx_model.graph.node]
+    num_fused = op_types.count('LayerNormalization')
+    if num_fused:
+        print(f"✓ {num_fused} fused LayerNormalization nodes")
+    elif 'ReduceMean' in op_types:
+        print("⚠ No LayerNormalization nodes; LayerNorm may have been decomposed into ReduceMean/Sub/Pow/Sqrt")
+    else:
+        print("⚠ No LayerNormalization nodes found in the exported graph")
+
+def _remove_stale_optimized(onnx_path):
+    # test-onnx-model.py caches ORT-optimized graphs next to each model
+    optimized_path = onnx_path.replace('.onnx', '.opt.onnx')
+    if os.path.exists(optimized_path):
+        os.remove(optimized_path)
+
+def _quantize_int8(fp32_path, int8_path, calibration_dir=None):
+    """
+    Post-training INT8 quantization of the MatMul/Gemm ops
+
+    Uses dynamic quantization by default. If calibration_dir is given,
+    static quantization is calibrated on 5s clips cut from the .wav files
+    in that directory instead.
+    """
+    import onnx
+    from onnxruntime.quantization import QuantType, quantize_dynamic, quantize_static
+
+    print(f"\nQuantizing to INT8: {int8_path}")
+
+    num_candidates = sum(
+        node.op_type in ('MatMul', 'Gemm') for node in onnx.load(fp32_path).graph.node
+    )
+    if not num_candidates:
+        print("⚠ Graph has no MatMul/Gemm nodes, skipping INT8 quantization")
+        return
+
+    try:
+        if calibration_dir:
+            print(f"Using static quantization calibrated on {calibration_dir}")
+            quantize_static(
+                fp32_path,
+                int8_path,
+                _CalibrationReader(calibration_dir),
+                weight_type=QuantType.QInt8,
+                activation_type=QuantType.QInt8,
+                op_types_to_quantize=['MatMul', 'Gemm']
+            )
+        else:
+            quantize_dynamic(
+                fp32_path,
+                int8_path,
+                weight_type=QuantType.QInt8,
+                op_types_to_quantize=['MatMul', 'Gemm']
+            )
+        _remove_stale_optimized(int8_path)
+    except Exception as e:
+        print(f"⚠ INT8 quantization failed: {e}")
+        return
+
+    # Dynamic quantization emits MatMulInteger, static emits QLinearMatMul
+    # (or QDQ pairs); count what actually got replaced
+    quantized_ops = ('MatMulInteger', 'QLinearMatMul', 'QGemm', 'QuantizeLinear')
+    num_quantized = sum(
+        node.op_type in quantized_ops for node in onnx.load(int8_path).graph.node
+    )
+    if num_quantized:
+        print(f"✓ INT8 model saved to {int8_path} ({num_quantized} quantized nodes, "
+              f"{num_candidates} MatMul/Gemm candidates)")
+    else:
+        print(f"⚠ No nodes were quantized; {int8_path} is equivalent to the FP32 model")
+
+class _CalibrationReader:
+    """Feeds representative 5s, 16kHz mono clips to quantize_static"""
+
+    def __init__(self, calibration_dir, clip_seconds=5, max_clips=32):
+        import torchaudio
+        from pathlib import Path
+
+        clip_length = 16000 * clip_seconds
+        clips = []
+        for wav_path in sorted(Path(calibration_dir).glob('*.wav')):
+            waveform, sr = torchaudio.load(str(wav_path))
+            if waveform.shape[0] > 1:
+                waveform = waveform.mean(dim=0, keepdim=True)
+            if sr != 16000:
+                waveform = torchaudio.functional.resample(waveform, sr, 16000)
+            for start in range(0, waveform.shape[1] - clip_length + 1, clip_length):
+                clips.append(waveform[:, start:start + clip_length].numpy())
+                if len(clips) >= max_clips:
+                    break
+            if len(clips) >= max_clips:
+                break
+
+        if not clips:
+            raise ValueError(f"No calibration clips found in {calibration_dir}")
+        print(f"Loaded {len(clips)} calibration clips")
+        self._clips = iter(clips)
+
+    def get_next(self):
+        clip = next(self._clips, None)
+        return None if clip is None else {'audio': clip}
 
 if __name__ == '__main__':
-    export_sepformer_to_onnx()
+    parser = argparse.ArgumentParser(description='Export SepFormer to ONNX')
+    parser.add_argument('--fp32', action='store_true',
+                        help='Export FP32 weights instead of FP16')
+    parser.add_argument('--no-int8', action='store_true',
+                        help='Skip the INT8 quantized export')
+    parser.add_argument('--calibration-dir', default=None,
+                        help='Directory of .wav clips for static INT8 calibration')
+    parser.add_argument('--no-buckets', action='store_true',
+                        help='Skip the fixed-length bucket exports')
+    parser.add_argument('--student', action='store_true',
+                        help='Also export a smaller student model to sepformer_student.onnx')
+    parser.add_argument('--student-source', default=None,
+                        help='Checkpoint for the student (default: the full model, truncated)')
+    parser.add_argument('--student-layers', type=int, default=2,
+                        help='Transformer layers to keep per masknet stack in the student')
+    args = parser.parse_args()
+    
+    options = dict(
+        fp16=not args.fp32,
+        int8=not args.no_int8,
+        calibration_dir=args.calibration_dir,
+        buckets=not args.no_buckets
+    )
+    export_sepformer_to_onnx(**options)
+    if args.student:
+        export_sepformer_to_onnx(
+            student=True,
+            student_source=args.student_source,
+            student_layers=args.student_layers,
+            **options
+        )
@@ -1,24 +1,212 @@
+import os
 import sys
 import json
+import argparse
+import itertools
+import threading
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import torchaudio
 import numpy as np
 from pathlib import Path
 from speechbrain.inference.separation import SepformerSeparation
 
+try:
+    import soxr
+except ImportError:
+    soxr = None
+
+try:
+    import soundfile as sf
+except ImportError:
+    sf = None
+
+SAMPLE_RATE = 16000
+
 class SepFormerService:
-    def __init__(self):
+    # Inputs longer than this are separated chunk by chunk
+    STREAMING_MIN_SECONDS = 30.0
+    
+    # torchaudio resamplers keyed by (orig_sr, new_sr), so each sinc filter is designed once
+    _resamplers = {}
+    
+    def __init__(self, max_batch=8, compile_masknet=False):
         self.model = None
+        self.max_batch = max_batch
+        self.compile_masknet = compile_masknet
+        self._output_layout = None
         
     def initialize(self):
         """Load the SepFormer model"""
         if self.model is None:
+            self._configure_threads()
             print("Loading SepFormer model...", file=sys.stderr)
             self.model = SepformerSeparation.from_hparams(
                 source='speechbrain/resepformer-wsj02mix',
                 savedir='models/sepformer/temp'
             )
             print("Model loaded successfully", file=sys.stderr)
+            
+            if self.compile_masknet:
+                # Compilation happens on the first call; dynamic=True avoids
+                # recompiling for every distinct input length
+                self.model.mods['masknet'] = torch.compile(
+                    self.model.mods['masknet'], dynamic=True
+                )
+                print("Compiled masknet with torch.compile", file=sys.stderr)
+            
+            # separate_batch returns either [batch, time, sources] or
+            # [batch, sources, time]; probe once instead of checking per call.
+            # Every separation path goes through separate_batch, and a 100 ms
+            # input is enough to tell the axes apart.
+            with torch.no_grad():
+                probe = self.model.separate_batch(torch.zeros(1, SAMPLE_RATE // 10))
+            num_spks = self.model.hparams.num_spks
+            self._output_layout = 'BTS' if probe.shape[-1] == num_spks else 'BST'
+            print(f"Model output layout: {self._output_layout}", file=sys.stderr)
+    
+    def _configure_threads(self):
+        """
+        Size torch's thread pools to the CPUs this process may run on
+        
+        Defaults can oversubscribe when several services share a machine. The
+        launcher partitions cores (e.g. via taskset -c), and this picks up that
+        affinity mask instead of the machine-wide core count.
+        """
+        if hasattr(os, 'sched_getaffinity'):
+            num_threads = len(os.sched_getaffinity(0))
+        else:
+            num_threads = os.cpu_count() or 1
+        
+        # OMP_NUM_THREADS/MKL_NUM_THREADS are read when torch is imported, so
+        # setting them here would be a no-op; set_num_threads sizes both pools
+        torch.set_num_threads(num_threads)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            # Only allowed before any inter-op parallel work has started
+            pass
+        print(f"Using {num_threads} intra-op threads", file=sys.stderr)
+    
+    def _resample(self, waveform, orig_sr, new_sr):
+        """Resample a [channels, time] waveform, preferring soxr's polyphase filter"""
+        if soxr is not None:
+            # soxr works on [time, channels]
+            resampled = soxr.resample(waveform.numpy().T, orig_sr, new_sr, quality='HQ')
+            return torch.from_numpy(np.ascontiguousarray(resampled.T))
+        key = (orig_sr, new_sr)
+        resampler = self._resamplers.get(key)
+        if resampler is None:
+            resampler = self._resamplers.setdefault(
+                key, torchaudio.transforms.Resample(orig_sr, new_sr)
+            )
+        return resampler(waveform)
+    
+    def _normalize_output(self, separated):
+        """Bring separate_batch output into [batch, sources, time] layout"""
+        if self._output_layout == 'BTS':
+            separated = separated.transpose(1, 2)
+        return separated
+    
+    def separate_streaming(self, waveform, chunk_s=4.0, left_s=1.0, right_s=0.5):
+        """
+        Separate a long [1, time] waveform in overlapping windows
+        
+        Each window is chunk_s of audio plus left_s/right_s of context. The
+        model is permutation-invariant, so sources in each window are
+        reordered to best match the previous window over their shared
+        samples, and the right-context region is cross-faded with a Hann
+        ramp.
+        
+        Args:
+            waveform: [1, time] tensor, or an iterable of consecutive [1, n]
+                blocks; blocks are only read as far ahead as the next window
+                needs, so peak memory stays O(chunk)
+        
+        Yields:
+            [sources, samples] tensors covering consecutive chunk_s spans
+        """
+        self.initialize()
+        
+        chunk = int(chunk_s * SAMPLE_RATE)
+        left = min(int(left_s * SAMPLE_RATE), chunk)
+        right = min(int(right_s * SAMPLE_RATE), chunk)
+        
+        fade_in = torch.hann_window(2 * right, periodic=True)[:right]
+        fade_out = 1.0 - fade_in
+        
+        blocks = iter([waveform] if isinstance(waveform, torch.Tensor) else waveform)
+        buffer = torch.zeros(1, 0)
+        buffer_start = 0  # absolute sample index of buffer[:, 0]
+        exhausted = False
+        
+        prev_overlap = None  # previous window's output over [start - left, start + right)
+        start = 0
+        while True:
+            while not exhausted and buffer_start + buffer.shape[-1] < start + chunk + right:
+                block = next(blocks, None)
+                if block is None:
+                    exhausted = True
+                else:
+                    buffer = torch.cat([buffer, block], dim=-1)
+            total = buffer_start + buffer.shape[-1]
+            if start >= total:
+                break
+            
+            win_start = max(start - left, 0)
+            win_end = min(start + chunk + right, total)
+            
+            with torch.no_grad():
+                separated = self._normalize_output(
+                    self.model.separate_batch(buffer[:, win_start - buffer_start:win_end - buffer_start])
+                )[0]
+            # Encoder striding can change the length slightly
+            win_len = win_end - win_start
+            if separated.shape[-1] < win_len:
+                separated = torch.nn.functional.pad(separated, (0, win_len - separated.shape[-1]))
+            separated = separated[:, :win_len]
+            
+            offset = start - win_start
+            if prev_overlap is not None:
+                overlap = separated[:, :prev_overlap.shape[-1]]
+                separated = separated[self._best_permutation(prev_overlap, overlap), :]
+            
+            end = min(start + chunk, total)
+            out = separated[:, offset:offset + (end - start)].clone()
+            if prev_overlap is not None:
+                fade = min(right, out.shape[-1], prev_overlap.shape[-1] - left)
+                if fade > 0:
+                    prev_right = prev_overlap[:, left:left + fade]
+                    out[:, :fade] = prev_right * fade_out[:fade] + out[:, :fade] * fade_in[:fade]
+            
+            # Keep what the next window will share with this one
+            next_start = start + chunk
+            prev_overlap = separated[:, next_start - left - win_start:]
+            
+            # Drop input the next window no longer needs
+            keep_from = next_start - left
+            if keep_from > buffer_start:
+                buffer = buffer[:, keep_from - buffer_start:]
+                buffer_start = keep_from
+            
+            start = next_start
+            yield out
+    
+    @staticmethod
+    def _best_permutation(reference, candidate):
+        """Source order of candidate that best correlates with reference"""
+        num_sources = reference.shape[0]
+        length = min(reference.shape[-1], candidate.shape[-1])
+        if length == 0:
+            return list(range(num_sources))
+        reference = reference[:, :length]
+        candidate = candidate[:, :length]
+        similarity = reference @ candidate.T  # [ref_source, cand_source]
+        return list(max(
+            itertools.permutations(range(num_sources)),
+            key=lambda perm: sum(similarity[i, j].item() for i, j in enumerate(perm))
+        ))
     
     def separate_audio(self, input_path, output_dir, num_sources=2):
         """
@@ -34,52 +222,324 @@ class SepFormerService:
         """
         self.initialize()
         
-        waveform, sr = torchaudio.load(input_path)
-        if sr != 16000:
-            resampler = torchaudio.transforms.Resample(sr, 16000)
-            waveform = resampler(waveform)
-            sr = 16000
+        if self._can_stream_from_disk(input_path):
+            return self._separate_long_file(input_path, output_dir, num_sources)
         
-        if waveform.shape[0] > 1:
-            waveform = torch.mean(waveform, dim=0, keepdim=True)
+        waveform, sr = self._load_waveform(input_path)
+        
+        if waveform.shape[-1] > self.STREAMING_MIN_SECONDS * sr:
+            return self._separate_long_file(input_path, output_dir, num_sources, waveform)
         
         with torch.no_grad():
-            separated = self.model.separate_batch(waveform)
+            separated = self._normalize_output(self.model.separate_batch(waveform))
             
         print(f"Separated audio shape: {separated.shape}", file=sys.stderr)
         
-        if len(separated.shape) == 3:
-            if separated.shape[1] == 2 or separated.shape[2] == 2:
-                if separated.shape[2] == 2:
-                    separated = separated.permute(0, 2, 1)  # -> [batch, sources, time]
+        return self._save_sources(separated[0], output_dir, num_sources, sr)
+    
+    def separate_batch_files(self, input_paths, output_dirs, num_sources=2):
+        """
+        Separate several audio files with batched separate_batch calls
+        
+        Inputs are sorted by length and grouped into batches of at most
+        max_batch, so each batch is zero-padded only up to its own longest
+        input. Lengths come from the file headers, and each batch's waveforms
+        are loaded only when it runs, so input memory is bounded by max_batch
+        as well. Inputs long enough for streaming are separated on their own.
+        
+        Args:
+            input_paths: Paths to input audio files
+            output_dirs: Output directory for each input
+            num_sources: Number of sources (currently model is fixed at 2)
+        
+        Returns:
+            List of output file path lists, in the order of input_paths
+        """
+        self.initialize()
+        
+        if len(input_paths) != len(output_dirs):
+            raise ValueError("input_paths and output_dirs must have the same length")
+        
+        results = [None] * len(input_paths)
+        batchable = []  # (index, duration in seconds, waveform if already loaded)
+        for index, input_path in enumerate(input_paths):
+            if self._can_stream_from_disk(input_path):
+                results[index] = self._separate_long_file(input_path, output_dirs[index], num_sources)
+                continue
+            
+            waveform = None
+            duration = self._header_duration(input_path)
+            if duration is None:
+                # soundfile can't read the header; load now to learn the length
+                waveform, sr = self._load_waveform(input_path)
+                duration = waveform.shape[-1] / sr
+            
+            if duration > self.STREAMING_MIN_SECONDS:
+                if waveform is None:
+                    waveform, _ = self._load_waveform(input_path)
+                results[index] = self._separate_long_file(
+                    input_path, output_dirs[index], num_sources, waveform
+                )
             else:
-                if separated.shape[1] > 2:
-                    separated = separated[:, :2, :]
-                else:
-                    separated = separated[:, :, :2].permute(0, 2, 1)
+                batchable.append((index, duration, waveform))
+        
+        batchable.sort(key=lambda item: item[1])
+        for batch_start in range(0, len(batchable), self.max_batch):
+            batch = batchable[batch_start:batch_start + self.max_batch]
+            indices = [index for index, _, _ in batch]
+            waveforms = [
+                waveform if waveform is not None else self._load_waveform(input_paths[index])[0]
+                for index, _, waveform in batch
+            ]
+            lengths = [waveform.shape[-1] for waveform in waveforms]
+            max_length = max(lengths)
+            stacked = torch.cat([
+                torch.nn.functional.pad(waveform, (0, max_length - waveform.shape[-1]))
+                for waveform in waveforms
+            ], dim=0)
+            del waveforms
+            
+            with torch.no_grad():
+                separated = self._normalize_output(self.model.separate_batch(stacked))
+            print(f"Separated batch shape: {separated.shape}", file=sys.stderr)
+            
+            for row, (index, length) in enumerate(zip(indices, lengths)):
+                results[index] = self._save_sources(
+                    separated[row, :, :length], output_dirs[index], num_sources, SAMPLE_RATE
+                )
+        
+        return results
+    
+    def _header_duration(self, input_path):
+        """Duration of input_path in seconds from its header, or None if soundfile can't read it"""
+        if sf is None:
+            return None
+        try:
+            return sf.info(input_path).duration
+        except RuntimeError:
+            return None
+    
+    def _can_stream_from_disk(self, input_path):
+        """Whether input_path is long enough to stream and can be read block by block"""
+        if sf is None:
+            return False
+        try:
+            info = sf.info(input_path)
+        except RuntimeError:
+            return False
+        # Block-wise resampling needs soxr's stateful stream resampler
+        if info.samplerate != SAMPLE_RATE and soxr is None:
+            return False
+        return info.duration > self.STREAMING_MIN_SECONDS
+    
+    def _read_blocks(self, input_path, block_seconds=4.0):
+        """Read input_path as consecutive [1, n] mono 16kHz blocks"""
+        with sf.SoundFile(input_path) as f:
+            sr = f.samplerate
+            frames = int(block_seconds * sr)
+            stream = None
+            if sr != SAMPLE_RATE:
+                stream = soxr.ResampleStream(sr, SAMPLE_RATE, 1, dtype='float32', quality='HQ')
+            
+            while True:
+                block = f.read(frames=frames, dtype='float32', always_2d=True)
+                last = len(block) < frames
+                block = block.mean(axis=1) if block.shape[1] > 1 else block[:, 0]
+                if stream is not None:
+                    block = stream.resample_chunk(block, last=last)
+                if len(block):
+                    yield torch.from_numpy(np.ascontiguousarray(block)).unsqueeze(0)
+                if last:
+                    break
+    
+    def _separate_long_file(self, input_path, output_dir, num_sources, waveform=None):
+        """
+        Stream-separate a long file, writing each chunk as soon as it is ready
+        
+        Reads input_path block by block unless an already loaded waveform is
+        given. Without soundfile the chunks are collected and saved at the end.
+        """
+        source = waveform if waveform is not None else self._read_blocks(input_path)
+        chunks = self.separate_streaming(source)
+        
+        if sf is None:
+            separated = torch.cat(list(chunks), dim=-1)
+            return self._save_sources(separated, output_dir, num_sources, SAMPLE_RATE)
         
-        # Save separated sources
-        output_paths = []
         Path(output_dir).mkdir(parents=True, exist_ok=True)
+        num_actual_sources = min(self.model.hparams.num_spks, num_sources)
+        output_paths = [
+            str(Path(output_dir) / f"source_{i}.wav") for i in range(num_actual_sources)
+        ]
         
-        num_actual_sources = min(separated.shape[1], num_sources)
-        for i in range(num_actual_sources):
-            source_audio = separated[0, i, :]  # Get source i
-            output_path = Path(output_dir) / f"source_{i}.wav"
-            torchaudio.save(
-                str(output_path),
-                source_audio.unsqueeze(0),  # Add channel dimension
-                sr
-            )
-            output_paths.append(str(output_path))
-            print(f"Saved source {i} to {output_path}", file=sys.stderr)
+        files = [
+            sf.SoundFile(path, 'w', samplerate=SAMPLE_RATE, channels=1, subtype='PCM_16')
+            for path in output_paths
+        ]
+        try:
+            for chunk in chunks:
+                chunk = chunk.clamp(-1, 1)
+                for i, f in enumerate(files):
+                    f.write(chunk[i].numpy())
+        finally:
+            for f in files:
+                f.close()
         
+        for i, path in enumerate(output_paths):
+            print(f"Saved source {i} to {path}", file=sys.stderr)
         return output_paths
+    
+    def _load_waveform(self, input_path):
+        """Load an audio file as a [1, time] waveform at 16kHz"""
+        waveform, sr = torchaudio.load(input_path)
+        # Downmix first so only one channel goes through the resampler
+        if waveform.shape[0] > 1:
+            waveform = waveform.mean(dim=0, keepdim=True)
+        
+        if sr != SAMPLE_RATE:
+            waveform = self._resample(waveform, sr, SAMPLE_RATE)
+            sr = SAMPLE_RATE
+        
+        return waveform, sr
+    
+    def _save_sources(self, separated, output_dir, num_sources, sr):
+        """Save a [sources, time] tensor as 16-bit PCM source_<i>.wav files in output_dir"""
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+        
+        num_actual_sources = min(separated.shape[0], num_sources)
+        output_paths = [
+            str(Path(output_dir) / f"source_{i}.wav") for i in range(num_actual_sources)
+        ]
+        
+        # One contiguous [sources, time] buffer; each row is then a plain view
+        sources = separated[:num_actual_sources].detach().cpu().contiguous()
+        
+        def save(i):
+            if sf is not None:
+                # PCM_16 wraps out-of-range samples instead of saturating
+                sf.write(output_paths[i], sources[i].clamp(-1, 1).numpy(), sr, subtype='PCM_16')
+            else:
+                torchaudio.save(
+                    output_paths[i],
+                    sources[i].clamp(-1, 1).unsqueeze(0),  # Add channel dimension
+                    sr,
+                    encoding='PCM_S',
+                    bits_per_sample=16
+                )
+            print(f"Saved source {i} to {output_paths[i]}", file=sys.stderr)
+        
+        # WAV encoding and writing release the GIL, so sources save in parallel
+        with ThreadPoolExecutor(max_workers=max(num_actual_sources, 1)) as executor:
+            list(executor.map(save, range(num_actual_sources)))
+        
+        return output_paths
+
+def handle_job(service, job):
+    """Run one separation job descriptor and build its JSON-serialisable result"""
+    result = {"id": job.get("id")} if isinstance(job, dict) else {}
+    try:
+        if "inputs" in job:
+            # Batch job: {"inputs": [{"input_path": ..., "output_dir": ...}, ...]}
+            all_output_paths = service.separate_batch_files(
+                [item["input_path"] for item in job["inputs"]],
+                [item["output_dir"] for item in job["inputs"]],
+                int(job.get("num_sources", 2))
+            )
+            result.update({
+                "success": True,
+                "results": [
+                    {"output_paths": output_paths, "num_sources": len(output_paths)}
+                    for output_paths in all_output_paths
+                ]
+            })
+            return result
+        
+        output_paths = service.separate_audio(
+            job["input_path"],
+            job["output_dir"],
+            int(job.get("num_sources", 2))
+        )
+        result.update({
+            "success": True,
+            "output_paths": output_paths,
+            "num_sources": len(output_paths)
+        })
+    except Exception as e:
+        result.update({
+            "success": False,
+            "error": str(e)
+        })
+    return result
+
+def serve_stdin(service):
+    """
+    Daemon mode: read newline-delimited JSON jobs from stdin and write one
+    JSON result per line to stdout, keeping the model loaded between jobs.
+    """
+    print(json.dumps({"ready": True}), flush=True)
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            job = json.loads(line)
+        except json.JSONDecodeError as e:
+            print(json.dumps({"success": False, "error": f"Invalid job: {e}"}), flush=True)
+            continue
+        print(json.dumps(handle_job(service, job)), flush=True)
+
+def serve_socket(service, socket_path):
+    """Daemon mode over a Unix domain socket, one JSON job per line"""
+    lock = threading.Lock()
+
+    class JobHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    job = json.loads(line)
+                except json.JSONDecodeError as e:
+                    result = {"success": False, "error": f"Invalid job: {e}"}
+                else:
+                    # The model is shared, so jobs from different clients run one at a time
+                    with lock:
+                        result = handle_job(service, job)
+                self.wfile.write((json.dumps(result) + "\n").encode())
+                self.wfile.flush()
+
+    Path(socket_path).unlink(missing_ok=True)
+    with socketserver.ThreadingUnixStreamServer(socket_path, JobHandler) as server:
+        print(f"Listening on {socket_path}", file=sys.stderr)
+        server.serve_forever()
 
 def main():
+    if '--daemon' in sys.argv[1:]:
+        parser = argparse.ArgumentParser(description='SepFormer separation daemon')
+        parser.add_argument('--daemon', action='store_true')
+        parser.add_argument('--socket', default=None,
+                            help='Serve on this Unix domain socket instead of stdin/stdout')
+        parser.add_argument('--max-batch', type=int, default=8,
+                            help='Maximum files per separate_batch call, bounds peak memory')
+        parser.add_argument('--compile', action='store_true',
+                            help='Fuse the masknet with torch.compile (needs a C++ compiler)')
+        args = parser.parse_args()
+        
+        service = SepFormerService(max_batch=args.max_batch, compile_masknet=args.compile)
+        service.initialize()
+        if args.socket:
+            serve_socket(service, args.socket)
+        else:
+            serve_stdin(service)
+        return
+    
     if len(sys.argv) < 3:
         print(json.dumps({
-            "error": "Usage: sepformer-python-service.py <input_audio> <output_dir> [num_sources]"
+            "error": "Usage: sepformer-python-service.py <input_audio> <output_dir> [num_sources] | --daemon [--socket <path>] [--max-batch N]"
         }))
         sys.exit(1)
     
@@ -3,14 +3,165 @@
 Test the exported ONNX SepFormer model
 """
 
+import os
+import re
+import glob
+import time
+import itertools
 import numpy as np
 import onnxruntime as ort
 
+# ORT_PROVIDER picks execution providers in priority order, e.g. "trt,cuda,cpu".
+# ORT_WARMUP and ORT_ITERATIONS control the latency benchmark.
+PROVIDERS = {
+    'trt': ('TensorrtExecutionProvider', {
+        'trt_fp16_enable': '1',
+        'trt_engine_cache_enable': '1',
+        'trt_engine_cache_path': 'models/sepformer/trt_cache',
+    }),
+    'cuda': ('CUDAExecutionProvider', {}),
+    'cpu': ('CPUExecutionProvider', {}),
+}
+
+# Fixed 5s input, generated once with np.random.default_rng(0), so runs are
+# comparable and no time goes into generating random samples
+DUMMY_AUDIO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'dummy_5s.npy')
+
+# Bucket outputs see zero padding the dynamic model doesn't, so they are only
+# expected to match it this closely
+BUCKET_MIN_SNR_DB = 20.0
+
+def load_dummy_audio(dtype=np.float32):
+    """The fixed [1, 80000] test input, regenerated from seed 0 if the fixture is missing"""
+    if os.path.exists(DUMMY_AUDIO_PATH):
+        audio = np.load(DUMMY_AUDIO_PATH)
+    else:
+        audio = np.random.default_rng(0).standard_normal((1, 16000 * 5), dtype=np.float32)
+    return audio.astype(dtype, copy=False)
+
+def get_providers():
+    """Requested providers that this onnxruntime build actually has"""
+    available = ort.get_available_providers()
+    requested = os.environ.get('ORT_PROVIDER', 'trt,cuda,cpu').split(',')
+    providers = [PROVIDERS[p.strip()] for p in requested if p.strip() in PROVIDERS]
+    providers = [p for p in providers if p[0] in available]
+    return providers or [PROVIDERS['cpu']]
+
+def physical_cores_in_affinity():
+    """
+    Physical cores in this process's CPU affinity mask
+    
+    Returns None when the mask covers every CPU, so ORT's own default (one
+    thread per physical core) applies. SMT siblings share a core, so they
+    are counted once via their sysfs (package, core) topology ids.
+    """
+    if not hasattr(os, 'sched_getaffinity'):
+        return None
+    cpus = os.sched_getaffinity(0)
+    if len(cpus) >= (os.cpu_count() or 0):
+        return None
+    
+    cores = set()
+    for cpu in cpus:
+        topology = f'/sys/devices/system/cpu/cpu{cpu}/topology'
+        try:
+            with open(f'{topology}/physical_package_id') as f:
+                package = f.read().strip()
+            with open(f'{topology}/core_id') as f:
+                core = f.read().strip()
+        except OSError:
+            # No topology information; treat each allowed CPU as a core
+            return len(cpus)
+        cores.add((package, core))
+    return len(cores)
+
+def create_session_options(optimized_model_path=None):
+    """SessionOptions with full graph optimization and one thread per physical core"""
+    so = ort.SessionOptions()
+    so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    so.enable_mem_pattern = True
+    so.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    # Under a taskset partition, stay within it; otherwise keep ORT's default
+    num_cores = physical_cores_in_affinity()
+    if num_cores:
+        so.intra_op_num_threads = num_cores
+    so.add_session_config_entry('session.intra_op.allow_spinning', '1')
+    if optimized_model_path:
+        so.optimized_model_filepath = optimized_model_path
+    return so
+
+def create_session(model_path, providers):
+    """
+    Create an InferenceSession, reusing a saved optimized graph when possible
+
+    The optimized graph is only cached for CPU-only sessions, since ORT_ENABLE_ALL
+    output can contain provider-specific fused ops.
+    """
+    if [name for name, _ in providers] != ['CPUExecutionProvider']:
+        return ort.InferenceSession(model_path, create_session_options(), providers=providers)
+    
+    optimized_path = model_path.replace('.onnx', '.opt.onnx')
+    if os.path.exists(optimized_path) and os.path.getmtime(optimized_path) >= os.path.getmtime(model_path):
+        print(f"Using cached optimized model {optimized_path}")
+        so = create_session_options()
+        so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        return ort.InferenceSession(optimized_path, so, providers=providers)
+    
+    return ort.InferenceSession(model_path, create_session_options(optimized_path), providers=providers)
+
+def create_io_binding(session, audio, output_shape, output_dtype):
+    """
+    Bind input and a pre-allocated output buffer so repeated runs of the same
+    shape reuse memory instead of allocating a fresh output every call.
+
+    On CUDA/TensorRT sessions both tensors are kept device-resident.
+
+    Returns:
+        (io_binding, read_output) where read_output() returns the output as numpy
+    """
+    input_name = session.get_inputs()[0].name
+    output_name = session.get_outputs()[0].name
+    io_binding = session.io_binding()
+    
+    if session.get_providers()[0] in ('TensorrtExecutionProvider', 'CUDAExecutionProvider'):
+        input_value = ort.OrtValue.ortvalue_from_numpy(audio, 'cuda', 0)
+        output_value = ort.OrtValue.ortvalue_from_shape_and_type(output_shape, output_dtype, 'cuda', 0)
+        io_binding.bind_ortvalue_input(input_name, input_value)
+        io_binding.bind_ortvalue_output(output_name, output_value)
+        return io_binding, output_value.numpy
+    
+    output = np.empty(output_shape, dtype=output_dtype)
+    io_binding.bind_cpu_input(input_name, audio)
+    io_binding.bind_output(output_name, 'cpu', 0, output_dtype, output.shape, output.ctypes.data)
+    return io_binding, lambda: output
+
+def benchmark(session, io_binding, warmup=3, iterations=20):
+    """
+    Time run_with_iobinding after warmup runs, so first-run costs such as
+    cuDNN autotuning or TensorRT engine builds are excluded.
+    """
+    for _ in range(warmup):
+        session.run_with_iobinding(io_binding)
+    
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        session.run_with_iobinding(io_binding)
+        timings.append((time.perf_counter() - start) * 1000)
+    
+    timings = np.array(timings)
+    print(f"\nLatency over {iterations} runs ({warmup} warmup, {session.get_providers()[0]}):")
+    print(f"  Mean: {timings.mean():.2f} ms")
+    print(f"  P99:  {np.percentile(timings, 99):.2f} ms")
+    return timings
+
 def test_onnx_model():
     model_path = 'models/sepformer/sepformer.onnx'
     
     print(f"Loading ONNX model from {model_path}")
-    session = ort.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+    providers = get_providers()
+    session = create_session(model_path, providers)
+    print(f"Providers: {session.get_providers()}")
     
     # Print model info
     print("\n" + "="*60)
@@ -36,7 +187,9 @@ def test_onnx_model():
     
     # Create dummy input (5 seconds at 16kHz)
     sample_length = 16000 * 5
-    dummy_audio = np.random.randn(1, sample_length).astype(np.float32)
+    # FP16 exports declare a tensor(float16) input
+    input_dtype = np.float16 if session.get_inputs()[0].type == 'tensor(float16)' else np.float32
+    dummy_audio = load_dummy_audio(input_dtype)[:, :sample_length]
     
     print(f"Input shape: {dummy_audio.shape}")
     print(f"Input dtype: {dummy_audio.dtype}")
@@ -64,15 +217,169 @@ def test_onnx_model():
                 print("   Your code expects variable num_sources input")
                 print("   You'll need to modify the TypeScript implementation")
         
+        io_binding, read_output = create_io_binding(session, dummy_audio, output.shape, output.dtype)
+        session.run_with_iobinding(io_binding)
+        bound_output = read_output()
+        print(f"\n✓ IOBinding inference successful!")
+        print(f"  Max diff vs session.run: {np.abs(bound_output.astype(np.float32) - output.astype(np.float32)).max():.6f}")
+        
+        benchmark(
+            session,
+            io_binding,
+            warmup=int(os.environ.get('ORT_WARMUP', 3)),
+            iterations=int(os.environ.get('ORT_ITERATIONS', 20))
+        )
+        
     except Exception as e:
         print(f"\n✗ Inference failed: {e}")
         return False
     
     return True
 
+def load_bucket_sessions(model_path, providers):
+    """Sessions for the <model>_<seconds>s.onnx bucket exports on disk, keyed by seconds"""
+    prefix = model_path[:-len('.onnx')]
+    bucket_pattern = re.compile(re.escape(prefix) + r'_(\d+)s\.onnx')
+    sessions = {}
+    for bucket_path in glob.glob(f'{prefix}_*s.onnx'):
+        match = bucket_pattern.fullmatch(bucket_path)
+        if match:
+            sessions[int(match.group(1))] = create_session(bucket_path, providers)
+    return sessions
+
+def run_bucketed(sessions, audio, sample_rate=16000):
+    """
+    Run [1, time] audio through the smallest bucket that fits it
+
+    The input is zero-padded to the bucket length and the output cropped
+    back to the input length.
+
+    Returns:
+        Separated audio, or None if no bucket is long enough
+    """
+    length = audio.shape[-1]
+    seconds = next((s for s in sorted(sessions) if s * sample_rate >= length), None)
+    if seconds is None:
+        return None
+    
+    session = sessions[seconds]
+    padded = np.zeros((audio.shape[0], seconds * sample_rate), dtype=audio.dtype)
+    padded[:, :length] = audio
+    output = session.run(
+        [session.get_outputs()[0].name],
+        {session.get_inputs()[0].name: padded}
+    )[0]
+    return output[..., :length]
+
+def test_bucketed_models():
+    """Check that bucketed inference matches the dynamic model on the same input"""
+    model_path = 'models/sepformer/sepformer.onnx'
+    providers = get_providers()
+    sessions = load_bucket_sessions(model_path, providers)
+    if not sessions:
+        print("\nNo bucket models found, skipping bucketed inference")
+        return True
+    
+    print("\n" + "="*60)
+    print(f"Testing bucketed inference ({', '.join(f'{s}s' for s in sorted(sessions))}):")
+    print("="*60)
+    
+    any_session = next(iter(sessions.values()))
+    input_dtype = np.float16 if any_session.get_inputs()[0].type == 'tensor(float16)' else np.float32
+    dummy_audio = load_dummy_audio(input_dtype)[:, :int(16000 * 3.2)]
+    
+    dynamic_session = create_session(model_path, providers)
+    
+    try:
+        output = run_bucketed(sessions, dummy_audio)
+        reference = dynamic_session.run(
+            [dynamic_session.get_outputs()[0].name],
+            {dynamic_session.get_inputs()[0].name: dummy_audio}
+        )[0]
+    except Exception as e:
+        print(f"✗ Bucketed inference failed: {e}")
+        return False
+    
+    if output is None:
+        print("✗ No bucket long enough for a 3.2s input")
+        return False
+    
+    if output.shape != reference.shape:
+        print(f"✗ Shape mismatch vs dynamic model: {output.shape} vs {reference.shape}")
+        return False
+    
+    # Padding can change which output slot each speaker lands in, so compare
+    # against the best source order
+    output = output.astype(np.float32)
+    reference = reference.astype(np.float32)
+    errors = [
+        output[:, list(perm)] - reference
+        for perm in itertools.permutations(range(output.shape[1]))
+    ]
+    error = min(errors, key=lambda e: np.sum(e ** 2))
+    snr = 10 * np.log10(np.sum(reference ** 2) / max(np.sum(error ** 2), 1e-12))
+    print(f"  Max abs diff vs dynamic model: {np.abs(error).max():.6f}")
+    print(f"  SNR vs dynamic model: {snr:.2f} dB")
+    
+    if snr < BUCKET_MIN_SNR_DB:
+        print(f"✗ Bucketed output diverges from the dynamic model (< {BUCKET_MIN_SNR_DB} dB)")
+        return False
+    
+    print(f"✓ Bucketed inference matches the dynamic model, output shape: {output.shape}")
+    return True
+
+def compare_int8_model():
+    """Compare the INT8 quantized model against the FP32 graph it was quantized from"""
+    model_path = 'models/sepformer/sepformer_fp32.onnx'
+    int8_path = 'models/sepformer/sepformer_int8.onnx'
+    
+    if not os.path.exists(int8_path):
+        print(f"\nNo INT8 model at {int8_path}, skipping comparison")
+        return True
+    
+    if not os.path.exists(model_path):
+        print(f"\nNo FP32 reference at {model_path}, skipping INT8 comparison")
+        return True
+    
+    print("\n" + "="*60)
+    print("Comparing INT8 vs FP32 reference model:")
+    print("="*60)
+    
+    # INT8 MatMulInteger kernels are CPU-only, so compare both on CPU
+    session = create_session(model_path, [PROVIDERS['cpu']])
+    int8_session = create_session(int8_path, [PROVIDERS['cpu']])
+    
+    sample_length = 16000 * 5
+    dummy_audio = load_dummy_audio()[:, :sample_length]
+    
+    def run(sess):
+        inp = sess.get_inputs()[0]
+        dtype = np.float16 if inp.type == 'tensor(float16)' else np.float32
+        out = sess.run([sess.get_outputs()[0].name], {inp.name: dummy_audio.astype(dtype)})
+        return out[0].astype(np.float32)
+    
+    try:
+        reference = run(session)
+        quantized = run(int8_session)
+    except Exception as e:
+        print(f"✗ Comparison failed: {e}")
+        return False
+    
+    if reference.shape != quantized.shape:
+        print(f"✗ Shape mismatch: {reference.shape} vs {quantized.shape}")
+        return False
+    
+    error = reference - quantized
+    snr = 10 * np.log10(np.sum(reference ** 2) / max(np.sum(error ** 2), 1e-12))
+    print(f"  Max abs diff: {np.abs(error).max():.6f}")
+    print(f"  Mean abs diff: {np.abs(error).mean():.6f}")
+    print(f"  SNR vs reference: {snr:.2f} dB")
+    
+    return True
+
 if __name__ == '__main__':
     try:
-        success = test_onnx_model()
+        success = test_onnx_model() and test_bucketed_models() and compare_int8_model()
         if success:
             print("\n" + "="*60)
             print("✓ ONNX model is ready to use!")
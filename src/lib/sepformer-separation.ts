@@ -1,4 +1,4 @@
-import { exec } from 'child_process';
+import { exec, spawn, ChildProcessWithoutNullStreams } from 'child_process';
 import { promisify } from 'util';
 import fs from 'fs/promises';
 import path from 'path';
@@ -15,9 +15,12 @@ interface SeparationSegment {
 }
 
 interface PythonServiceResponse {
+  id?: number;
+  ready?: boolean;
   success: boolean;
   output_paths?: string[];
   num_sources?: number;
+  results?: Array<{ output_paths: string[]; num_sources: number }>;
   error?: string;
 }
 
@@ -27,6 +30,13 @@ export class SepFormerSeparation {
   private static instance: SepFormerSeparation | null = null;
   private processing: boolean = false;
   private tempFiles: Set<string> = new Set();
+  private daemon: ChildProcessWithoutNullStreams | null = null;
+  private daemonReady: Promise<void> | null = null;
+  private nextJobId: number = 0;
+  private pendingJobs: Map<number, {
+    resolve: (response: PythonServiceResponse) => void;
+    reject: (error: Error) => void;
+  }> = new Map();
 
   constructor() {
     this.pythonServicePath = './scripts/sepformer-python-service.py';
@@ -61,6 +71,156 @@ export class SepFormerSeparation {
     }
   }
 
+  private startDaemon(): Promise<void> {
+    if (this.daemonReady) return this.daemonReady;
+
+    this.daemonReady = new Promise<void>((resolve, reject) => {
+      // SEPFORMER_CPUS (e.g. "0-3") pins the daemon to a core range with taskset,
+      // so concurrent services on one machine don't oversubscribe each other
+      const cpus = process.env.SEPFORMER_CPUS;
+      const pythonArgs = [this.pythonServicePath, '--daemon'];
+      const daemon = cpus
+        ? spawn('taskset', ['-c', cpus, 'python3', ...pythonArgs])
+        : spawn('python3', pythonArgs);
+      this.daemon = daemon;
+      let stdoutBuffer = '';
+      let ready = false;
+
+      daemon.stdout.on('data', (chunk: Buffer) => {
+        stdoutBuffer += chunk.toString();
+        let newline: number;
+        while ((newline = stdoutBuffer.indexOf('\n')) >= 0) {
+          const line = stdoutBuffer.slice(0, newline).trim();
+          stdoutBuffer = stdoutBuffer.slice(newline + 1);
+          if (!line) continue;
+
+          let response: PythonServiceResponse;
+          try {
+            response = JSON.parse(line);
+          } catch {
+            console.warn('Python service output:', line);
+            continue;
+          }
+
+          if (response.ready) {
+            ready = true;
+            console.log('SepFormer Python daemon ready');
+            resolve();
+            continue;
+          }
+
+          if (response.id === undefined) continue;
+          const job = this.pendingJobs.get(response.id);
+          if (job) {
+            this.pendingJobs.delete(response.id);
+            job.resolve(response);
+          }
+        }
+      });
+
+      daemon.stderr.on('data', (chunk: Buffer) => {
+        const message = chunk.toString();
+        if (!message.includes('UserWarning')) {
+          console.warn('Python service warnings:', message);
+        }
+      });
+
+      const onExit = (reason: string) => {
+        const error = new Error(`Python daemon exited: ${reason}`);
+        // A daemon killed by stopDaemon has already been replaced or reset
+        if (this.daemon === daemon) this.resetDaemon(error);
+        if (!ready) reject(error);
+      };
+
+      // Writing to a daemon that just died raises EPIPE here; the exit
+      // handler rejects the pending jobs
+      daemon.stdin.on('error', (error) => {
+        console.warn('Python daemon stdin error:', error.message);
+      });
+      daemon.on('error', (error) => onExit(error.message));
+      daemon.on('exit', (code, signal) => onExit(`code ${code}, signal ${signal}`));
+    });
+
+    return this.daemonReady;
+  }
+
+  private resetDaemon(error: Error): void {
+    this.daemon = null;
+    this.daemonReady = null;
+    for (const job of this.pendingJobs.values()) {
+      job.reject(error);
+    }
+    this.pendingJobs.clear();
+  }
+
+  // The daemon runs jobs one at a time, so a stuck or abandoned job would
+  // block every later one; kill it and let the next call respawn it
+  private stopDaemon(daemon: ChildProcessWithoutNullStreams, reason: string): void {
+    // A later call may already have replaced the daemon that ran this job
+    if (this.daemon !== daemon) return;
+    this.resetDaemon(new Error(`Python daemon stopped: ${reason}`));
+    daemon.kill();
+  }
+
+  private async runSeparationJob(
+    inputs: Array<{ inputPath: string; outputDir: string }>,
+    numSources: number,
+    abortSignal?: AbortSignal
+  ): Promise<PythonServiceResponse> {
+    await this.startDaemon();
+
+    if (abortSignal?.aborted) {
+      throw new Error('Operation aborted');
+    }
+
+    // The daemon can exit between its ready line and this write; check
+    // before arming the timeout or registering the job
+    const daemon = this.daemon;
+    if (!daemon) {
+      throw new Error('Python daemon is not running');
+    }
+
+    const id = this.nextJobId++;
+    return new Promise<PythonServiceResponse>((resolve, reject) => {
+      const timeout = setTimeout(() => {
+        abortSignal?.removeEventListener('abort', onAbort);
+        this.pendingJobs.delete(id);
+        this.stopDaemon(daemon, 'job timed out');
+        reject(new Error('Python service timed out'));
+      }, 120000 * Math.max(inputs.length, 1));
+
+      const onAbort = () => {
+        clearTimeout(timeout);
+        this.pendingJobs.delete(id);
+        this.stopDaemon(daemon, 'job aborted');
+        reject(new Error('Operation aborted'));
+      };
+      abortSignal?.addEventListener('abort', onAbort, { once: true });
+
+      this.pendingJobs.set(id, {
+        resolve: (response) => {
+          clearTimeout(timeout);
+          abortSignal?.removeEventListener('abort', onAbort);
+          resolve(response);
+        },
+        reject: (error) => {
+          clearTimeout(timeout);
+          abortSignal?.removeEventListener('abort', onAbort);
+          reject(error);
+        },
+      });
+
+      daemon.stdin.write(JSON.stringify({
+        id,
+        inputs: inputs.map(({ inputPath, outputDir }) => ({
+          input_path: inputPath,
+          output_dir: outputDir,
+        })),
+        num_sources: numSources,
+      }) + '\n');
+    });
+  }
+
   private async cleanupTempFiles(): Promise<void> {
     const cleanup = Array.from(this.tempFiles);
     this.tempFiles.clear();
@@ -137,6 +297,7 @@ export class SepFormerSeparation {
 
       console.log(`Processing ${numSpeakers} speakers with ${segments.length} total segments`);
 
+      const jobs: Array<{ inputPath: string; outputDir: string }> = [];
       for (let i = 0; i < segments.length; i++) {
         if (abortSignal?.aborted) {
           await this.cleanupTempFiles();
@@ -160,31 +321,32 @@ export class SepFormerSeparation {
           segmentInputPath,
           abortSignal
         );
+        jobs.push({ inputPath: segmentInputPath, outputDir: separatedOutputDir });
+      }
 
-        if (abortSignal?.aborted) {
-          await this.cleanupTempFiles();
-          throw new Error('Operation aborted');
-        }
-
-        const pythonCmd = `python3 "${this.pythonServicePath}" "${segmentInputPath}" "${separatedOutputDir}" ${Math.min(numSpeakers, 2)}`;
-        const { stdout, stderr } = await execAsync(pythonCmd, {
-          maxBuffer: 50 * 1024 * 1024,
-          timeout: 120000,
-          signal: abortSignal as any
-        });
+      if (abortSignal?.aborted) {
+        await this.cleanupTempFiles();
+        throw new Error('Operation aborted');
+      }
 
-        if (stderr && !stderr.includes('UserWarning')) {
-          console.warn('Python service warnings:', stderr);
-        }
+      // All segments go to the daemon as one job so it can batch them
+      const response = await this.runSeparationJob(
+        jobs,
+        Math.min(numSpeakers, 2),
+        abortSignal
+      );
+      if (!response.success || !response.results) {
+        throw new Error(`Python service failed: ${response.error}`);
+      }
 
-        const response: PythonServiceResponse = JSON.parse(stdout.trim().split('\n').pop() || '{}');
-        if (!response.success) {
-          throw new Error(`Python service failed: ${response.error}`);
-        }
+      for (let i = 0; i < segments.length; i++) {
+        const segment = segments[i];
+        const { inputPath: segmentInputPath, outputDir: separatedOutputDir } = jobs[i];
+        const outputPaths = response.results[i]?.output_paths;
 
         const speakerIndex = Array.from(speakerSegments.keys()).indexOf(segment.speaker);
-        const sourceIndex = Math.min(speakerIndex, (response.output_paths?.length || 1) - 1);
-        const sourcePath = response.output_paths?.[sourceIndex];
+        const sourceIndex = Math.min(speakerIndex, (outputPaths?.length || 1) - 1);
+        const sourcePath = outputPaths?.[sourceIndex];
         if (!sourcePath) {
           throw new Error(`No output for speaker ${segment.speaker}`);
         }
@@ -199,8 +361,8 @@ export class SepFormerSeparation {
         await fs.unlink(segmentInputPath).catch(() => {});
         this.tempFiles.delete(segmentInputPath);
         
-        if (response.output_paths) {
-          for (const outPath of response.output_paths) {
+        if (outputPaths) {
+          for (const outPath of outputPaths) {
             await fs.unlink(outPath).catch(() => {});
           }
         }